@@ -1,146 +1,401 @@
-import streamlit as st
-from llama_index.llms.ollama import Ollama
-from llama_index.core.llms import ChatMessage
-import logging
-import pyperclip
-import time
-import ollama
-from typing import Dict, Generator
-
-def ollama_generator(model_name: str, messages: Dict) -> Generator:
-    stream = ollama.chat(
-        model=model_name, messages=messages, stream=True)
-    for chunk in stream:
-        yield chunk['message']['content']
-
-# Page configuration settings for the Streamlit app
-PAGE_CONFIG = {
-    "page_title": "CARL", 
-    "layout": "centered", 
-    "initial_sidebar_state": "auto",
-    "page_icon": "🦜",
-    "initial_sidebar_state": "collapsed"
-}
-
-# Set the page configuration using the defined settings
-st.set_page_config(**PAGE_CONFIG)
-
-# Configure logging to display information during runtime
-logging.basicConfig(level=logging.INFO)
-
-# Initialize chat history in session state if it does not exist
-if 'messages' not in st.session_state:
-    st.session_state.messages = []
-
-def stream_chat(model, messages):
-    try:
-        # Initialize the model with a request timeout
-        llm = Ollama(model=model, request_timeout=240.0)
-        resp = llm.stream_chat(messages)  # Start streaming responses from the model
-        response = ""
-        response_placeholder = st.empty()  # Placeholder for dynamic response display
-        
-        # Append streamed response segments to the response variable
-        for r in resp:
-            response += r.delta
-            response_placeholder.write(response)  # Update the placeholder with the current response
-            
-            # Append the current segment to the session state as an assistant message
-            st.session_state.messages.append({"role": "assistant", "content": r.delta})
-        
-        # Log the model used and the messages exchanged
-        logging.info(f"Model: {model}, Messages: {messages}, Response: {response}")
-        return response
-    except Exception as e:
-        # Log any errors encountered during the streaming process
-        logging.error(f"Error during streaming: {str(e)}")
-        raise e
-
-def copy_to_clipboard(message):
-    pyperclip.copy(message)  # Copy the message to the clipboard
-    st.success("Message copied to clipboard!")  # Notify the user
-
-def main():
-    # Set the main title and subtitle for the app
-    st.markdown("<h1 style='text-align: center;'>CARL (Research)</h1>", unsafe_allow_html=True)
-    st.markdown("<h2 style='text-align: center;'>Corporate Assistant for Rapid Lookups</h2>", unsafe_allow_html=True)
-    logging.info("App started")
-
-    # Sidebar for model selection
-    model = st.sidebar.selectbox("Choose a model", ["llama3.2:1b", "llama3.1", "tinyllama", "llama3", "mistral-small"])
-    logging.info(f"Model selected: {model}")
-    
-
-    # Sidebar option to display duration of response
-    show_duration = st.sidebar.radio("Show Duration?", ["Yes", "No"])
-    logging.info(f"Show Duration: {show_duration}")
-
-    # Button to clear chat history
-    if st.sidebar.button("Clear Cache"):
-        st.cache_data.clear()  # Clear the cache
-        success_message = st.success("Cache cleared!")  # Show success message
-        
-        # Use a placeholder to manage the message display
-        time.sleep(5)  # Wait for 5 seconds
-        success_message.empty()  # Remove the success message
-
-    # Button to clear data cache
-    if st.sidebar.button("Clear History"):
-        st.session_state.messages.clear()  # Clear the chat history
-        success_message = st.success("Chat History cleared!")  # Show success message
-        
-        # Use a placeholder to manage the message display
-        time.sleep(5)  # Wait for 5 seconds
-        success_message.empty()  # Remove the success message
-
-    # Input field for user question
-    prompt = st.chat_input("Your question")
-    if prompt:
-        st.session_state.messages.append({"role": "user", "content": prompt})  # Append user prompt to chat history
-        logging.info(f"User input: {prompt}")
-
-        # Display user messages from the chat history
-        for message in st.session_state.messages:
-            with st.chat_message(message["role"]):
-                st.write(message["content"])  # Display the message content
-
-        # Generate a response only if the last message was from the user
-        if st.session_state.messages[-1]["role"] == "user":
-            start_time = time.time()  # Start timing the response generation
-            logging.info("Generating response")
-
-        with st.spinner("Thinking..."):
-            try:
-                # Prepare messages for the model
-                messages = [ChatMessage(role=msg["role"], content=msg["content"]) for msg in st.session_state.messages]
-                
-                # Get the model's response
-                response_message = stream_chat(model, messages)
-
-                # Log the response and duration
-                duration = time.time() - start_time
-                logging.info(f"Response: {response_message}, Duration: {duration:.2f} s")
-
-                # Append the response to the session state as the assistant's message
-                st.session_state.messages.append(
-                    {"role": "assistant", "content": response_message})
-
-                #with st.chat_message("assistant"):
-                #    response = st.write_stream(ollama_generator(
-                #        st.session_state.selected_model, st.session_state.messages))
-                #st.session_state.messages.append(
-                #    {"role": "assistant", "content": response})
-
-
-            except Exception as e:
-                # Handle errors during response generation
-                error_message = "I am sorry Dave, I cannot do that."  # More user-friendly error message
-                st.session_state.messages.append({"role": "assistant", "content": error_message})  # Append error as assistant message
-                st.error(error_message)
-                logging.error(f"Error: {str(e)}")
-
-
-
-# Entry point for running the app
-if __name__ == "__main__":
-    main()
+import asyncio
+import hashlib
+import html
+from collections import OrderedDict
+from dataclasses import dataclass
+import httpx
+import streamlit as st
+from llama_index.llms.ollama import Ollama
+from llama_index.core.llms import ChatMessage
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
+import threading
+import time
+import ollama
+from typing import Dict, Generator
+
+def ollama_generator(model_name: str, messages: Dict) -> Generator:
+    stream = ollama.chat(
+        model=model_name, messages=messages, stream=True)
+    for chunk in stream:
+        yield chunk['message']['content']
+
+# Page configuration settings for the Streamlit app
+PAGE_CONFIG = {
+    "page_title": "CARL",
+    "layout": "centered",
+    "page_icon": "🦜",
+    "initial_sidebar_state": "collapsed"
+}
+
+# Set the page configuration using the defined settings
+st.set_page_config(**PAGE_CONFIG)
+
+# Precomposed page header so each rerun issues a single markdown call
+# instead of rebuilding and sanitizing two HTML strings
+HEADER_HTML = (
+    "<h1 style='text-align: center;'>CARL (Research)</h1>"
+    "<h2 style='text-align: center;'>Corporate Assistant for Rapid Lookups</h2>"
+)
+
+def _bootstrap():
+    # Streamlit re-executes this whole module on every rerun, so any setup
+    # that should happen once per session is collected here behind the
+    # _bootstrapped guard below
+
+    # Route log records through a queue drained by a daemon-thread listener,
+    # so logging on the streaming hot path is just an enqueue and never
+    # serializes with rendering on stderr I/O. Handlers are per-process, so
+    # guard against a second session adding another queue
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    if not any(isinstance(h, QueueHandler) for h in root.handlers):
+        log_queue = queue.Queue(-1)
+        root.addHandler(QueueHandler(log_queue))
+        QueueListener(log_queue, logging.StreamHandler()).start()
+
+    # Default the Ollama server (when launched from this environment) to a
+    # quantized KV cache: q8_0 halves KV bytes per generated token, which on
+    # memory-bound laptop decode is close to a linear speedup. Flash attention
+    # must be on for KV quantization to take effect
+    os.environ.setdefault("OLLAMA_FLASH_ATTENTION", "1")
+    os.environ.setdefault("OLLAMA_KV_CACHE_TYPE", "q8_0")
+
+    # Initialize the chat history plus the parallel ChatMessage history so
+    # the prior conversation is not re-boxed into ChatMessage every turn
+    st.session_state.messages = []
+    st.session_state.chat_messages = []
+
+if not st.session_state.get('_bootstrapped'):
+    _bootstrap()
+    st.session_state._bootstrapped = True
+
+# Offered models; the q4_K_M tags trade ~4x fewer weight bytes than F16 for
+# a small quality loss, a good default on laptop-class hosts
+MODEL_CHOICES = [
+    "llama3.2:1b",
+    "llama3.2:1b-instruct-q4_K_M",
+    "llama3.1",
+    "llama3.1:8b-instruct-q4_K_M",
+    "tinyllama",
+    "llama3",
+    "mistral-small",
+]
+
+# Hoisted constructor reference to skip the module attribute lookup at each
+# call site. This must be the real constructor: content is not a pydantic
+# field on current ChatMessage but a property backed by blocks, and only
+# __init__ converts the content kwarg into a TextBlock — model_construct
+# bypasses that and yields messages whose content is None
+_chat_message = ChatMessage
+
+@dataclass(slots=True, frozen=True)
+class LiteMessage:
+    # Slim slotted record for session history: rerun paths read attributes
+    # instead of hashing dict keys, and instances are smaller than dicts.
+    # Frozen so finalized turns can never be mutated — Ollama skips prefill
+    # for a prompt prefix only while it matches the previous request byte
+    # for byte. The Pydantic ChatMessage is built once per message, for the LLM
+    role: str
+    content: str
+
+def append_message(role, content):
+    # Keep the lightweight history and the ChatMessage history in lockstep
+    st.session_state.messages.append(LiteMessage(role, content))
+    st.session_state.chat_messages.append(_chat_message(role=role, content=content))
+
+# Context sent to the model: the last CONTEXT_WINDOW_TURNS messages verbatim
+# plus a summary of everything older, produced by a small cheap model and
+# refreshed only after the older portion grows by SUMMARY_REFRESH messages
+CONTEXT_WINDOW_TURNS = 8
+SUMMARY_MODEL = "tinyllama"
+SUMMARY_REFRESH = 4
+
+def summarize_history(head):
+    # Condense the older turns once with the small model; the result is
+    # cached in session state so this does not run on every turn
+    transcript = "\n".join(f"{m.role}: {m.content}" for m in head)
+    prompt = [_chat_message(role="user", content=(
+        "Summarize this conversation in one short paragraph, keeping any "
+        "facts, names, and decisions:\n" + transcript))]
+    return get_llm(SUMMARY_MODEL).chat(prompt).message.content
+
+def build_context(k=CONTEXT_WINDOW_TURNS):
+    # Bound the prompt sent per turn: full history prefill grows linearly
+    # with conversation length, so older turns are folded into a cached
+    # summary and everything after the summarized portion travels verbatim.
+    # The verbatim tail stays bounded at k + SUMMARY_REFRESH - 1 messages,
+    # and between refreshes the prompt is append-only — summary message and
+    # tail are byte-identical to the previous turn plus the new messages —
+    # which is what lets Ollama's prompt-prefix KV cache skip the prefill
+    msgs = st.session_state.chat_messages
+    head = st.session_state.messages[:-k]
+    if not head:
+        return msgs
+    if 'summary' not in st.session_state or len(head) - st.session_state.get('summary_len', 0) >= SUMMARY_REFRESH:
+        st.session_state.summary = summarize_history(head)
+        st.session_state.summary_len = len(head)
+    summary_msg = _chat_message(
+        role="system",
+        content=f"Summary of the earlier conversation: {st.session_state.summary}",
+    )
+    # Resume right after the summarized prefix so no message is ever in
+    # neither the summary nor the tail
+    return [summary_msg] + msgs[st.session_state.summary_len:]
+
+# Maximum number of finished responses kept for exact-repeat prompts
+RESPONSE_CACHE_SIZE = 100
+
+@st.cache_resource
+def get_response_cache():
+    # LRU map from a (model, messages) hash to the finished response; lives
+    # in cache_resource so it survives reruns and is dropped by Clear Cache
+    return OrderedDict()
+
+def response_cache_key(model, messages):
+    payload = json.dumps([model] + [[str(m.role), m.content] for m in messages])
+    return hashlib.blake2b(payload.encode()).hexdigest()
+
+@st.cache_resource
+def get_llm(model: str, request_timeout: float = 240.0, num_batch: int = 256, num_ctx: int = 2048):
+    # Build the Ollama client once per (model, timeout, options) and reuse it
+    # across turns so the HTTP session survives instead of being rebuilt per
+    # message. Server-side parallelism and KV-cache precision are controlled
+    # by the OLLAMA_NUM_PARALLEL and OLLAMA_KV_CACHE_TYPE env vars instead
+    # Keep connections alive between turns so turn 2+ skips the TCP
+    # handshake. The wrapper silently drops unknown kwargs (client_kwargs
+    # included), so the pool settings must ride on prebuilt ollama clients
+    # injected through the client/async_client parameters it does accept
+    host = "http://localhost:11434"
+    limits = httpx.Limits(max_keepalive_connections=8, keepalive_expiry=300)
+    return Ollama(
+        model=model,
+        base_url=host,
+        request_timeout=request_timeout,
+        # Keep the model resident between turns so prefix KV reuse applies
+        # instead of a cold load + full re-prefill after idle gaps
+        keep_alive="30m",
+        client=ollama.Client(host=host, timeout=request_timeout, limits=limits),
+        async_client=ollama.AsyncClient(host=host, timeout=request_timeout, limits=limits),
+        # The wrapper maps context_window to num_ctx and merges
+        # additional_kwargs straight into the request options, so the knobs
+        # must be flat — nesting them under an "options" key would send
+        # options={"options": ...}, which the server ignores
+        context_window=num_ctx,
+        additional_kwargs={
+            "num_batch": num_batch,
+            "num_thread": max(1, os.cpu_count() // 2),
+        },
+    )
+
+@st.cache_resource
+def get_event_loop():
+    # One long-lived event loop on a daemon thread. The cached Ollama client
+    # keeps its async httpx pool bound to the loop it first ran on, so the
+    # loop must outlive individual turns — a loop-per-call here would leave
+    # turn 2+ reusing keepalive connections attached to a closed loop
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def _token_gen(llm, messages):
+    # Pump the async token stream from the shared background loop so
+    # st.write_stream can consume it as a plain generator; network waits
+    # still yield to the event loop rather than blocking mid-token
+    loop = get_event_loop()
+    resp = asyncio.run_coroutine_threadsafe(llm.astream_chat(messages), loop).result()
+    while True:
+        try:
+            r = asyncio.run_coroutine_threadsafe(resp.__anext__(), loop).result()
+        except StopAsyncIteration:
+            break
+        yield r.delta
+
+def stream_chat(model, messages, num_batch=256, num_ctx=2048):
+    try:
+        # Serve exact repeats of (model, history) straight from the cache
+        # without touching Ollama at all
+        cache = get_response_cache()
+        key = response_cache_key(model, messages)
+        if key in cache:
+            cache.move_to_end(key)
+            response = cache[key]
+            st.write(response)
+            logging.info("Model: %s, response served from cache", model)
+            return response
+
+        # Fetch the cached model client
+        llm = get_llm(model, num_batch=num_batch, num_ctx=num_ctx)
+
+        # st.write_stream buffers the deltas and updates the DOM
+        # incrementally, replacing the old manual placeholder + flush loop
+        response = st.write_stream(_token_gen(llm, messages))
+
+        # Remember the finished response, evicting the least recent entry
+        cache[key] = response
+        if len(cache) > RESPONSE_CACHE_SIZE:
+            cache.popitem(last=False)
+
+        # Log lazily via %-args so nothing is formatted when the record is
+        # discarded, and never stringify the full history — its repr grows
+        # linearly with conversation length
+        logging.info("Model: %s, messages: %d, response(len=%d): %.200s",
+                     model, len(messages), len(response), response)
+        return response
+    except Exception as e:
+        # Log any errors encountered during the streaming process
+        logging.error("Error during streaming: %s", e)
+        raise e
+
+# One delegated click listener for every data-copy button on the page. It
+# must execute in the parent document's context: the buttons rendered by
+# st.markdown live there, and so do the click's user activation and focus —
+# a clipboard call made from the component iframe is rejected by the
+# browser. The button briefly shows success or failure after each click
+_COPY_LISTENER = """
+document.addEventListener('click', function (e) {
+    var t = e.target;
+    if (!t || !t.dataset || t.dataset.copy === undefined) { return; }
+    function flash(mark) {
+        t.textContent = mark;
+        setTimeout(function () { t.textContent = '🔗'; }, 1200);
+    }
+    navigator.clipboard.writeText(t.dataset.copy).then(
+        function () { flash('✅'); },
+        function () { flash('⚠️'); }
+    );
+});
+"""
+
+# The component script only bootstraps: it creates a <script> element via
+# the parent document so the listener above runs in the parent context,
+# and installs it exactly once per page
+COPY_HANDLER_JS = (
+    "<script>"
+    "(function () {"
+    "  var doc = window.parent.document;"
+    "  if (doc.getElementById('carl-copy-handler')) { return; }"
+    "  var s = doc.createElement('script');"
+    "  s.id = 'carl-copy-handler';"
+    f"  s.textContent = {json.dumps(_COPY_LISTENER)};"
+    "  doc.body.appendChild(s);"
+    "})();"
+    "</script>"
+)
+
+def install_copy_handler():
+    # Install the single delegated clipboard handler; call once per rerun
+    st.components.v1.html(COPY_HANDLER_JS, height=0)
+
+def copy_button(message):
+    # Zero-widget copy affordance: a plain data-attribute button picked up
+    # by the delegated handler, so no server round-trip and no per-message
+    # entry in Streamlit's widget registry. Newlines must become character
+    # references: markdown terminates raw HTML at a blank line, so a literal
+    # paragraph break inside the attribute would split the markup and render
+    # it as text (the entities decode back to newlines in dataset.copy)
+    escaped = html.escape(message, quote=True).replace("\r", "&#13;").replace("\n", "&#10;")
+    st.markdown(
+        f'<button data-copy="{escaped}" title="Copy to clipboard">🔗</button>',
+        unsafe_allow_html=True,
+    )
+
+@st.fragment
+def render_history():
+    # Draw the transcript inside a fragment so interactions within it rerun
+    # only this block, not the whole script
+    install_copy_handler()
+    for message in st.session_state.messages:
+        with st.chat_message(message.role):
+            st.write(message.content)  # Display the message content
+            copy_button(message.content)
+
+def main():
+    # Set the main title and subtitle for the app
+    st.markdown(HEADER_HTML, unsafe_allow_html=True)
+    logging.info("App started")
+
+    # Sidebar for model selection
+    model = st.sidebar.selectbox("Choose a model", MODEL_CHOICES)
+    logging.info("Model selected: %s", model)
+    
+
+    # Tuning knobs for constrained hosts; forwarded to Ollama as options
+    with st.sidebar.expander("Advanced"):
+        num_batch = st.slider("num_batch", 32, 1024, 256, 32)
+        num_ctx = st.slider("Context window", 512, 8192, 2048, 512)
+
+    # Sidebar option to display duration of response
+    show_duration = st.sidebar.radio("Show Duration?", ["Yes", "No"])
+    logging.info("Show Duration: %s", show_duration)
+
+    # Button to clear chat history
+    if st.sidebar.button("Clear Cache"):
+        st.cache_data.clear()  # Clear the cache
+        st.cache_resource.clear()  # Drop cached model clients too
+        st.toast("Cache cleared!", icon="✅")  # Auto-dismissing, non-blocking notice
+
+    # Button to clear data cache
+    if st.sidebar.button("Clear History"):
+        st.session_state.messages.clear()  # Clear the chat history
+        st.session_state.chat_messages.clear()  # Keep the ChatMessage history in sync
+        st.session_state.pop('summary', None)  # Drop the rolling context summary too
+        st.session_state.pop('summary_len', None)
+        st.toast("Chat History cleared!", icon="✅")  # Auto-dismissing, non-blocking notice
+
+    # Input field for user question (chat_input stays pinned to the bottom
+    # regardless of call order)
+    prompt = st.chat_input("Your question")
+    if prompt:
+        append_message("user", prompt)  # Append user prompt to chat history
+        logging.info("User input: %.200s", prompt)
+
+    # Display the chat history on every rerun — model changes, slider moves
+    # and cache clears must not blank the transcript. Called after the
+    # prompt append so a just-submitted message is part of the transcript
+    render_history()
+
+    if prompt:
+        # Generate a response only if the last message was from the user
+        if st.session_state.messages[-1].role == "user":
+            start_time = time.time()  # Start timing the response generation
+            logging.info("Generating response")
+
+        with st.spinner("Thinking..."):
+            try:
+                # Send a bounded context: recent turns plus a summary of the rest
+                messages = build_context()
+
+                # Get the model's response
+                response_message = stream_chat(model, messages, num_batch=num_batch, num_ctx=num_ctx)
+
+                # Log the response and duration
+                duration = time.time() - start_time
+                logging.info("Response(len=%d): %.200s, Duration: %.2f s",
+                             len(response_message), response_message, duration)
+
+                # Append the response to the session state as the assistant's message
+                append_message("assistant", response_message)
+
+                #with st.chat_message("assistant"):
+                #    response = st.write_stream(ollama_generator(
+                #        st.session_state.selected_model, st.session_state.messages))
+                #st.session_state.messages.append(
+                #    {"role": "assistant", "content": response})
+
+
+            except Exception as e:
+                # Handle errors during response generation
+                error_message = "I am sorry Dave, I cannot do that."  # More user-friendly error message
+                append_message("assistant", error_message)  # Append error as assistant message
+                st.error(error_message)
+                logging.error("Error: %s", e)
+
+
+
+# Entry point for running the app
+if __name__ == "__main__":
+    main()
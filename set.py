@@ -1,3 +1,3 @@
-# Set up seperate virtual environment for CARL
-virtualenv carl
-.\carl\Scripts\activate
+# Set up seperate virtual environment for CARL
+virtualenv carl
+.\carl\Scripts\activate